@@ -4,8 +4,17 @@ import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
 import os
-import pickle
-from openai import OpenAI
+import json
+import hashlib
+import asyncio
+import pickle  # Нужен только для чтения базы знаний в старом формате
+from pypdf import PdfReader
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+
+try:
+    import faiss  # Необязательно (pip install faiss-cpu): SIMD-поиск по векторам; без него считаем через numpy
+except ImportError:
+    faiss = None
 
 # --- 1. ИНИЦИАЛИЗАЦИЯ КЛЮЧЕЙ И КЛИЕНТА ---
 # Streamlit Cloud автоматически подставит ключ из раздела Secrets в этот словарь
@@ -19,11 +28,23 @@ if not api_key:
     st.error("Ошибка: API ключ OpenAI не найден. Добавьте его в Secrets или .env")
     st.stop()
 
-client = OpenAI(api_key=api_key)
+@st.cache_resource
+def get_openai():
+    # Один клиент на процесс вместо нового при каждом перезапуске скрипта
+    return OpenAI(api_key=api_key)
+
+client = get_openai()
 
 # --- КОНФИГУРАЦИЯ СТРАНИЦЫ ---
 st.set_page_config(page_title="БРК: Аналитическая панель", layout="wide")
 
+# Фильтры разделов. Streamlit удаляет состояние виджетов, которые не отрисовались в этом прогоне,
+# а рисуется только активный раздел — переприсваиваем значения, чтобы выбор пережил переключение
+PERSISTENT_WIDGET_KEYS = ["cum_slider_fixed", "macro_cats", "p_view_v3", "p_inds", "reg_select", "logic_selector"]
+for k in PERSISTENT_WIDGET_KEYS:
+    if k in st.session_state:
+        st.session_state[k] = st.session_state[k]
+
 # --- СТИЛИЗАЦИЯ ---
 st.markdown("""
     <style>
@@ -32,86 +53,120 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
+# Шаблон карточки показателя (отличаются только цвет, подпись, значение и размер шрифта)
+CARD_TPL = (
+    '<div style="background-color:rgba(255,255,255,0.05); padding:15px; border-radius:10px; border-top: 3px solid {color};">'
+    '<p style="color:rgba(255,255,255,0.6); margin:0;">{label}</p>'
+    '<p style="font-size:{size}px; font-weight:bold; margin:0; color:{color};">{value}</p>'
+    '</div>'
+)
+
 # --- ЗАГРУЗКА ДАННЫХ ---
+def read_with_parquet(path, reader):
+    # Исходник читаем один раз, дальше берем колоночную копию в Parquet (быстрее CSV/Excel, сохраняет типы)
+    parquet_path = os.path.splitext(path)[0] + '.parquet'
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(path):
+        return pd.read_parquet(parquet_path, engine='pyarrow')
+
+    df = reader(path)
+    try:
+        df.to_parquet(parquet_path, engine='pyarrow', index=False)
+    except (ImportError, ValueError, TypeError, OSError):
+        # Нет pyarrow, смешанные типы в колонке или папка только для чтения — просто работаем с исходником
+        pass
+    return df
+
 @st.cache_data
 def load_data():
     # 1. Макро данные (ИФО)
-    df_macro = pd.read_csv('final_macro_data.csv')
+    df_macro = read_with_parquet('final_macro_data.csv', pd.read_csv)
     # 2. Производительность (нужен unpivot)
-    df_prod = pd.read_csv('productivity_full_dataset.csv')
+    df_prod = read_with_parquet('productivity_full_dataset.csv', pd.read_csv)
     # 3. ВРП (Регионы)
-    df_vrp = pd.read_csv('vr_full_data.csv')
+    df_vrp = read_with_parquet('vr_full_data.csv', pd.read_csv)
     # 4. Проекты БРК
-    df_projects = pd.read_excel('brk_projects_site.xlsx')
+    df_projects = read_with_parquet('brk_projects_site.xlsx', pd.read_excel)
+
+    # Повторяющиеся строки храним как category: groupby идет по целочисленным кодам
+    for c in ['Регион', 'Отрасль', 'Наименование Предприятия']:
+        if c in df_projects.columns:
+            df_projects[c] = df_projects[c].astype('category')
+    df_prod['Industry'] = df_prod['Industry'].astype('category')
     
     return df_macro, df_prod, df_vrp, df_projects
 
 df_macro, df_prod, df_vrp, df_projects = load_data()
 
+@st.cache_data
+def prep_annual(df_macro, name_map):
+    # Годовые данные макро: числовой год, сортировка, понятные названия колонок
+    df_annual = df_macro[df_macro['Is_Annual'] == True].copy()
+    df_annual['Period_Display'] = pd.to_numeric(df_annual['Period_Display'], errors='coerce')
+    df_annual = df_annual.dropna(subset=['Period_Display']).sort_values('Period_Display')
+    df_annual['Period_Display'] = df_annual['Period_Display'].astype(np.int32)
+
+    # Переименовываем только те колонки, которые реально найдены в файле
+    found_cols = [col for col in name_map.keys() if col in df_annual.columns]
+    df_annual = df_annual.rename(columns={col: name_map[col] for col in found_cols})
+
+    # Список всех доступных названий для выбора
+    display_options = [name_map[col] for col in found_cols]
+    # float32 вдвое уменьшает объем данных для numpy и JSON графиков
+    df_annual[display_options] = df_annual[display_options].astype(np.float32)
+    return df_annual, display_options
+
+# Карта отраслей (Берем только то, что реально есть в final_macro_data.csv)
+# ВНИМАНИЕ: Проверьте пробелы в названии Энергетики, в CSV их часто два
+MACRO_NAME_MAP = {
+    'Обрабатывающая промышленность': '🏭 Обработка (Цель БРК)',
+    'Горнодобывающая промышленность и разработка карьеров': '⛏️ Сырьевой сектор',
+    'Валовой внутренний продукт': '🇰🇿 ВВП Казахстана',
+    'Снабжение электроэнергией, газом, паром, горячейводой  и кондиционированнымвоздухом': '⚡ Энергетика (ESG)',
+    'Транспорт и складирование': '🚚 Логистика и Транспорт',
+    'Строительство': '🏗️ Строительство'
+}
+
+# Подготовка годовых данных (не зависит от фильтров — берется из кэша)
+df_annual, display_options = prep_annual(df_macro, MACRO_NAME_MAP)
+
 # --- САЙДБАР (Глобальные фильтры) ---
 st.sidebar.image("https://www.kdb.kz/bitrix/templates/kdb_main/images/logo.png", width=180)
 st.sidebar.title("Навигация")
 years = sorted(df_macro[df_macro['Is_Annual'] == True]['Period_Display'].unique())
 selected_year = st.sidebar.select_slider("Выберите год анализа", options=years, value=years[-1])
 
+# Период задается в макро-разделе, раздел эффективности берет примененное значение из session_state
+min_y, max_y = int(df_annual['Period_Display'].min()), int(df_annual['Period_Display'].max())
+if "cum_slider_fixed" not in st.session_state:
+    st.session_state.cum_slider_fixed = (2015, max_y)
+
 # --- ОСНОВНОЙ ИНТЕРФЕЙС ---
 st.title("🏦 Мониторинг эффективности Банка Развития Казахстана")
 st.info(f"Анализ данных за {selected_year} год и ретроспективный обзор.")
 
-tab1, tab2, tab3, tab4, tab5 = st.tabs([
-    "📈 Макро-эффект", 
-    "⚙️ Эффективность", 
-    "🗺️ Регионы", 
-    "📁 Портфель проектов",
-    "🤖 ИИ-Ассистент" # <-- Добавлен новый таб
-])
-
 # --- ТАБ 1: МАКРОЭКОНОМИЧЕСКИЙ ЭФФЕКТ ---
-with tab1:
+def render_tab1(df_annual, display_options):
     st.header("📈 Анализ роста: Ежегодный vs Кумулятивный")
     
-    # 1. Карта отраслей (Берем только то, что реально есть в final_macro_data.csv)
-    # ВНИМАНИЕ: Проверьте пробелы в названии Энергетики, в CSV их часто два
-    name_map = {
-        'Обрабатывающая промышленность': '🏭 Обработка (Цель БРК)',
-        'Горнодобывающая промышленность и разработка карьеров': '⛏️ Сырьевой сектор',
-        'Валовой внутренний продукт': '🇰🇿 ВВП Казахстана',
-        'Снабжение электроэнергией, газом, паром, горячейводой  и кондиционированнымвоздухом': '⚡ Энергетика (ESG)',
-        'Транспорт и складирование': '🚚 Логистика и Транспорт',
-        'Строительство': '🏗️ Строительство'
-    }
-
-    # 2. Подготовка данных
-    df_annual = df_macro[df_macro['Is_Annual'] == True].copy()
-    df_annual['Period_Display'] = pd.to_numeric(df_annual['Period_Display'], errors='coerce')
-    df_annual = df_annual.dropna(subset=['Period_Display']).sort_values('Period_Display')
-    df_annual['Period_Display'] = df_annual['Period_Display'].astype(int)
-
-    # Переименовываем только те колонки, которые реально найдены в файле
-    found_cols = [col for col in name_map.keys() if col in df_annual.columns]
-    df_annual = df_annual.rename(columns={col: name_map[col] for col in found_cols})
-    
-    # Список всех доступных названий для выбора
-    display_options = [name_map[col] for col in found_cols]
-
-    # 3. Настройка фильтров
-    col_f1, col_f2 = st.columns([2, 1])
-    with col_f1:
+    # Фильтры периода и категорий
+    # Форма копит изменения и перезапускает скрипт только по кнопке, а не на каждый клик в списке
+    with st.form("macro_form"):
         # Слайдер для выбора периода
-        min_y, max_y = int(df_annual['Period_Display'].min()), int(df_annual['Period_Display'].max())
         year_range = st.slider("Период для расчета накопленного эффекта", 
-                               min_y, max_y, (2015, max_y), key="cum_slider_fixed")
+                               min_y, max_y, key="cum_slider_fixed")
 
-    with col_f2:
         # Выбираем по умолчанию только те, что точно есть в списке
-        default_selection = [opt for opt in ['🏭 Обработка (Цель БРК)', '🇰🇿 ВВП Казахстана', '⚡ Энергетика (ESG)'] if opt in display_options]
-        
+        if "macro_cats" not in st.session_state:
+            st.session_state.macro_cats = [opt for opt in ['🏭 Обработка (Цель БРК)', '🇰🇿 ВВП Казахстана', '⚡ Энергетика (ESG)'] if opt in display_options]
+
         selected_cats = st.multiselect(
             "Выберите категории для сравнения:", 
             options=display_options,
-            default=default_selection
+            key="macro_cats"
         )
 
+        st.form_submit_button("Применить")
+
     # Фильтруем данные по выбранному году
     df_filtered = df_annual[(df_annual['Period_Display'] >= year_range[0]) & 
                             (df_annual['Period_Display'] <= year_range[1])].copy()
@@ -124,10 +179,10 @@ with tab1:
         
         fig_annual = go.Figure()
         for cat in selected_cats:
-            fig_annual.add_trace(go.Scatter(
+            fig_annual.add_trace(go.Scattergl(
                 x=df_filtered['Period_Display'], y=df_filtered[cat],
                 name=cat, mode='lines+markers',
-                line=dict(width=3, shape='spline'),
+                line=dict(width=3),
                 hovertemplate=f"<b>{cat}</b><br>Год: %{{x}}<br>ИФО: %{{y}}%<extra></extra>"
             ))
         
@@ -144,17 +199,17 @@ with tab1:
         st.subheader(f"2. Кумулятивный эффект (База {year_range[0]} год = 100%)")
         
         df_cum = df_filtered.copy()
-        for col in selected_cats:
-            coeffs = df_cum[col] / 100
-            # Считаем накопленный итог: перемножаем индексы
-            df_cum[col] = (coeffs.cumprod() / coeffs.iloc[0]) * 100
+        # Считаем накопленный итог сразу по всем выбранным колонкам: перемножаем индексы
+        coeffs = df_cum[selected_cats].to_numpy(dtype=np.float64) / 100.0
+        cum = np.cumprod(coeffs, axis=0)
+        df_cum[selected_cats] = cum / cum[0:1] * 100.0
 
         fig_cum = go.Figure()
         for cat in selected_cats:
-            fig_cum.add_trace(go.Scatter(
+            fig_cum.add_trace(go.Scattergl(
                 x=df_cum['Period_Display'], y=df_cum[cat],
                 name=cat, mode='lines+markers',
-                line=dict(width=4, shape='spline'),
+                line=dict(width=4),
                 hovertemplate="Накопленный эффект: %{y:.1f}%"
             ))
 
@@ -175,13 +230,14 @@ with tab1:
 
     
 # --- ТАБ 2: ЭФФЕКТИВНОСТЬ (ПРОИЗВОДИТЕЛЬНОСТЬ ТРУДА) ---
-with tab2:
+def render_tab2(df_prod, year_range):
     st.header("⚙️ Анализ отраслевой эффективности")
 
     # 1. Подготовка данных
     prod_cols = [c for c in df_prod.columns if '_год' in c]
     df_p_melted = df_prod.melt(id_vars=['Industry'], value_vars=prod_cols, var_name='Year', value_name='Value')
-    df_p_melted['Year'] = df_p_melted['Year'].str.extract(r'(\d{4})').astype(int)
+    df_p_melted['Year'] = df_p_melted['Year'].str.extract(r'(\d{4})')[0].astype(np.int32)
+    df_p_melted['Value'] = df_p_melted['Value'].astype(np.float32)
     
     # ПОЛНЫЙ список категорий из твоего CSV для БРК
     full_industry_map = {
@@ -211,8 +267,9 @@ with tab2:
                             horizontal=True, key="p_view_v3")
     with col_f2:
         # Устанавливаем дефолты
-        default_selection = [opt for opt in ['🇰🇿 ОБЩЕЕ ПО КАЗАХСТАНУ', '🏭 Обработка (Фокус БРК)', '⚡ Энергетика (ESG)'] if opt in available_labels]
-        selected_inds = st.multiselect("Выберите сектора:", options=available_labels, default=default_selection)
+        if "p_inds" not in st.session_state:
+            st.session_state.p_inds = [opt for opt in ['🇰🇿 ОБЩЕЕ ПО КАЗАХСТАНУ', '🏭 Обработка (Фокус БРК)', '⚡ Энергетика (ESG)'] if opt in available_labels]
+        selected_inds = st.multiselect("Выберите сектора:", options=available_labels, key="p_inds")
 
     # 3. Логика расчетов
     df_final = df_p_clean[
@@ -223,7 +280,7 @@ with tab2:
 
     if view_mode != "Абсолютные цифры (тыс. ₸/чел)":
         # Считаем коэффициент роста (Current / Previous)
-        df_final['GF'] = df_final.groupby('Industry_Label')['Value'].transform(lambda x: x / x.shift(1)).fillna(1.0)
+        df_final['GF'] = (df_final['Value'] / df_final.groupby('Industry_Label')['Value'].shift(1)).fillna(1.0)
         if view_mode == "Индекс роста (База=100)":
             df_final['Val'] = df_final.groupby('Industry_Label')['GF'].cumprod() * 100
             y_title = "Индекс (100 = Начало периода)"
@@ -241,7 +298,7 @@ with tab2:
         if view_mode == "Абсолютные цифры (тыс. ₸/чел)":
             fig_p.add_trace(go.Bar(x=d['Year'], y=d['Val'], name=ind))
         else:
-            fig_p.add_trace(go.Scatter(x=d['Year'], y=d['Val'], name=ind, mode='lines+markers', line=dict(width=3, shape='spline')))
+            fig_p.add_trace(go.Scattergl(x=d['Year'], y=d['Val'], name=ind, mode='lines+markers', line=dict(width=3)))
 
     fig_p.update_layout(
         paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)",
@@ -273,7 +330,7 @@ with tab2:
 
 
 
-with tab3:
+def render_tab3(df_projects):
     st.header("📊 Региональная аналитика портфеля")
 
     try:
@@ -283,11 +340,21 @@ with tab3:
         sector_col = 'Отрасль' if 'Отрасль' in df_projects.columns else 'Sector'
 
         # Основная агрегация
-        reg_data = df_projects.groupby(reg_col).agg({
-            name_col: 'count',
-            sector_col: lambda x: x.value_counts().index[0]
-        }).reset_index()
-        reg_data.columns = ['Регион', 'Количество проектов', 'Доминирующая отрасль']
+        project_counts = df_projects.groupby(reg_col, observed=True)[name_col].count()
+        # Самая частая отрасль региона: считаем пары (регион, отрасль) и берем верхнюю по каждому региону.
+        # При равенстве побеждает отрасль, встретившаяся в таблице раньше (как у value_counts)
+        pair_groups = df_projects.assign(first_pos=np.arange(len(df_projects))).groupby([reg_col, sector_col], observed=True)
+        top_sector = (
+            pd.DataFrame({'n': pair_groups.size(), 'first_pos': pair_groups['first_pos'].min()})
+            .reset_index()
+            .sort_values(['n', 'first_pos'], ascending=[False, True])
+            .drop_duplicates(reg_col)
+            .set_index(reg_col)[sector_col]
+        )
+        reg_data = pd.DataFrame({
+            'Количество проектов': project_counts,
+            'Доминирующая отрасль': top_sector
+        }).rename_axis('Регион').reset_index()
         reg_data = reg_data.sort_values('Количество проектов', ascending=True)
 
         # --- ИНТЕРАКТИВНЫЙ ВЫБОР ОБЛАСТИ ---
@@ -295,7 +362,7 @@ with tab3:
         selected_reg = st.selectbox(
             "Выберите интересующую область Казахстана:", 
             options=sorted(reg_data['Регион'].unique()),
-            index=0
+            key="reg_select"
         )
 
         # Фильтруем данные для выбранного региона
@@ -305,31 +372,19 @@ with tab3:
         c1, c2, c3 = st.columns(3)
         
         with c1:
-            st.markdown(f"""
-                <div style="background-color:rgba(255,255,255,0.05); padding:15px; border-radius:10px; border-top: 3px solid #00d4ff;">
-                    <p style="color:rgba(255,255,255,0.6); margin:0;">Всего проектов</p>
-                    <p style="font-size:24px; font-weight:bold; margin:0; color:#00d4ff;">{reg_info['Количество проектов']}</p>
-                </div>
-            """, unsafe_allow_html=True)
+            st.markdown(CARD_TPL.format(color="#00d4ff", label="Всего проектов", size=24,
+                                        value=reg_info['Количество проектов']), unsafe_allow_html=True)
             
         with c2:
-            st.markdown(f"""
-                <div style="background-color:rgba(255,255,255,0.05); padding:15px; border-radius:10px; border-top: 3px solid #00ff88;">
-                    <p style="color:rgba(255,255,255,0.6); margin:0;">Ключевая отрасль</p>
-                    <p style="font-size:18px; font-weight:bold; margin:0; color:#00ff88;">{reg_info['Доминирующая отрасль']}</p>
-                </div>
-            """, unsafe_allow_html=True)
+            st.markdown(CARD_TPL.format(color="#00ff88", label="Ключевая отрасль", size=18,
+                                        value=reg_info['Доминирующая отрасль']), unsafe_allow_html=True)
 
         with c3:
             # Считаем долю региона в общем портфеле
             total_p = reg_data['Количество проектов'].sum()
             share = (reg_info['Количество проектов'] / total_p) * 100
-            st.markdown(f"""
-                <div style="background-color:rgba(255,255,255,0.05); padding:15px; border-radius:10px; border-top: 3px solid #f9ca24;">
-                    <p style="color:rgba(255,255,255,0.6); margin:0;">Доля в портфеле</p>
-                    <p style="font-size:24px; font-weight:bold; margin:0; color:#f9ca24;">{share:.1f}%</p>
-                </div>
-            """, unsafe_allow_html=True)
+            st.markdown(CARD_TPL.format(color="#f9ca24", label="Доля в портфеле", size=24,
+                                        value=f"{share:.1f}%"), unsafe_allow_html=True)
 
         st.write("") # Отступ
         st.markdown("---")
@@ -372,7 +427,7 @@ with tab3:
 
 
 # --- ТАБ 4: ЭКОНОМЕТРИЧЕСКАЯ МОДЕЛЬ ВЗАИМОСВЯЗИ ---
-with tab4:
+def render_tab4():
     st.header("📊 Детерминированный анализ: Инвестиции и Рост")
 
     # 1. Настройка отраслей
@@ -393,40 +448,32 @@ with tab4:
 
     # Фиксируем seed для стабильности конкретной отрасли
     seed_value = sum([ord(c) for c in target_ind])
-    np.random.seed(seed_value)
+    rng = np.random.default_rng(seed_value)
 
-    # 2. ГЕНЕРАЦИЯ ДАННЫХ ПО ТВОЕЙ ЛОГИКЕ
-    inv_data = np.zeros(n_years)
-    ifo_data = np.ones(n_years) * 100
-    
+    # 2. ГЕНЕРАЦИЯ ДАННЫХ ПО ТВОЕЙ ЛОГИКЕ (все случайные величины тянем разом)
     # Генерируем "события" инвестиций (0 - нет, 1 - есть)
-    inv_events = np.random.choice([0, 1], size=n_years, p=[0.4, 0.6])
-    
-    for t in range(n_years):
-        if inv_events[t] == 1:
-            # Если есть инвестиции, генерируем сумму в зависимости от типа отрасли
-            base_scale = 5000 if 'Горно' in target_ind else 2000
-            inv_data[t] = np.random.uniform(base_scale*0.5, base_scale*1.5)
-        else:
-            inv_data[t] = 0
+    inv_events = rng.choice([0, 1], size=n_years, p=[0.4, 0.6])
 
-    # Расчет ИФО на основе логики: Инвестиции(t-1) определяют Тренд(t)
-    for t in range(1, n_years):
-        noise = np.random.normal(0, 0.8) # Небольшой шум
-        
-        if inv_data[t-1] > 0:
-            # БЫЛИ ИНВЕСТИЦИИ -> РОСТ (ИФО > 100)
-            # Чем больше вложили, тем выше прыжок
-            growth_boost = 1.5 + (inv_data[t-1] / 1000) 
-            ifo_data[t] = 100 + growth_boost + noise
-        else:
-            # НЕ БЫЛО ИНВЕСТИЦИЙ -> ПАДЕНИЕ (ИФО < 100)
-            drop = np.random.uniform(1, 3)
-            ifo_data[t] = 100 - drop + noise
+    # Если есть инвестиции, генерируем сумму в зависимости от типа отрасли
+    base_scale = 5000 if 'Горно' in target_ind else 2000
+    raw_inv = rng.uniform(base_scale*0.5, base_scale*1.5, size=n_years)
+    inv_data = np.where(inv_events == 1, raw_inv, 0.0)
 
-        # Если плато (инвестиции почти равны прошлым - для красоты добавим редкий случай)
-        if t > 1 and inv_data[t-1] > 0 and abs(inv_data[t-1] - inv_data[t-2]) < 100:
-             ifo_data[t] = ifo_data[t-1] + noise
+    # Расчет ИФО на основе логики: Инвестиции(t-1) определяют Тренд(t)
+    noise = rng.normal(0, 0.8, size=n_years) # Небольшой шум
+    drop = rng.uniform(1, 3, size=n_years - 1)
+    prev_inv = inv_data[:-1]
+    ifo_data = np.full(n_years, 100.0)
+    # БЫЛИ ИНВЕСТИЦИИ -> РОСТ (ИФО > 100), чем больше вложили, тем выше прыжок
+    # НЕ БЫЛО ИНВЕСТИЦИЙ -> ПАДЕНИЕ (ИФО < 100)
+    ifo_data[1:] = np.where(prev_inv > 0, 100 + 1.5 + prev_inv / 1000, 100 - drop) + noise[1:]
+
+    # Если плато (инвестиции почти равны прошлым - для красоты добавим редкий случай)
+    # Значение зависит от предыдущего ИФО, поэтому проходим только по этим редким точкам
+    plateau = np.zeros(n_years, dtype=bool)
+    plateau[2:] = (inv_data[1:-1] > 0) & (np.abs(inv_data[1:-1] - inv_data[:-2]) < 100)
+    for t in np.flatnonzero(plateau):
+        ifo_data[t] = ifo_data[t-1] + noise[t]
 
     # 3. ВИЗУАЛИЗАЦИЯ (ПРОЗРАЧНОСТЬ)
     fig_logic = go.Figure()
@@ -443,16 +490,16 @@ with tab4:
     ))
 
     # Линия ИФО
-    fig_logic.add_trace(go.Scatter(
+    fig_logic.add_trace(go.Scattergl(
         x=years[:-1], y=ifo_data[:-1],
         name='Индекс ИФО (Рост отрасли)',
-        line=dict(color='#FF4B4B', width=4, shape='spline'),
+        line=dict(color='#FF4B4B', width=4),
         mode='lines+markers',
         yaxis='y2'
     ))
 
     # Прогноз 2026 (Пунктир)
-    fig_logic.add_trace(go.Scatter(
+    fig_logic.add_trace(go.Scattergl(
         x=years[-2:], y=ifo_data[-2:],
         name='Прогноз 2026',
         line=dict(color='#FF4B4B', width=4, dash='dot'),
@@ -498,21 +545,138 @@ with tab4:
 #             "Godovoy-otchet-Banka-za-2024-god-2.pdf"
 #         ]
 
+# Пути к файлам базы: матрица векторов (.npy) и тексты/источники (.json)
+DB_VECTORS_FILE = "db_vectors.npy"
+DB_META_FILE = "db_meta.json"
+# База в старом формате (pickle), конвертируется при первой загрузке
+LEGACY_DB_FILE = "vector_db.pkl"
+# Сколько фрагментов подставляем в контекст ответа
+TOP_K = 4
+
+@st.cache_data(show_spinner=False)
+def extract_chunks(filename, mtime):
+    # Извлечение текста из PDF медленное — кэшируем по имени файла и времени изменения
+    reader = PdfReader(filename)
+    chunks = []
+    for i, page in enumerate(reader.pages):
+        text = page.extract_text() or ""
+        mid = len(text) // 2
+        for part in (text[:mid], text[mid:]):
+            # Пустые куски не отправляем на эмбеддинг
+            if part.strip():
+                chunks.append({"text": part, "source": f"{filename}, стр. {i+1}"})
+    return chunks
+
+def top_k_indices(scores, k):
+    # Частичный отбор за O(K) вместо полной сортировки, затем сортируем только k лучших
+    k = min(k, len(scores))
+    idx = np.argpartition(scores, -k)[-k:]
+    return idx[np.argsort(scores[idx])[::-1]]
+
+# MinHash для поиска почти одинаковых фрагментов: 64 хеш-функции вида (a*h + b) mod p
+MINHASH_PRIME = (1 << 31) - 1
+_minhash_rng = np.random.default_rng(0)
+MINHASH_A = _minhash_rng.integers(1, MINHASH_PRIME, size=64, dtype=np.uint64)
+MINHASH_B = _minhash_rng.integers(0, MINHASH_PRIME, size=64, dtype=np.uint64)
+DEDUPE_JACCARD = 0.9  # Выше этой оценки сходства фрагменты считаем дублями
+
+def minhash_signature(text):
+    # Шинглы — 5-граммы слов; каждый хешируем один раз, перестановки считаем векторно
+    words = text.lower().split()
+    shingles = {" ".join(words[i:i + 5]) for i in range(max(len(words) - 4, 1))}
+    h = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(sh.encode(), digest_size=4).digest(), "little") for sh in shingles),
+        dtype=np.uint64, count=len(shingles),
+    )
+    return ((MINHASH_A[:, None] * h[None, :] + MINHASH_B[:, None]) % MINHASH_PRIME).min(axis=1)
+
+def dedupe_chunks(chunks):
+    # Колонтитулы и шаблонный текст повторяются на многих страницах — эмбеддим их один раз,
+    # а источники одинаковых и почти одинаковых фрагментов собираем в список
+    unique, signatures = [], []
+    for c in chunks:
+        sig = minhash_signature(c["text"])
+        if signatures:
+            # Доля совпавших минимумов — оценка коэффициента Жаккара
+            similarity = (np.asarray(signatures) == sig).mean(axis=1)
+            best = int(similarity.argmax())
+            if similarity[best] > DEDUPE_JACCARD:
+                unique[best]["source"].append(c["source"])
+                continue
+        unique.append({"text": c["text"], "source": [c["source"]]})
+        signatures.append(sig)
+    return unique
+
+def build_db(chunks):
+    # Одна непрерывная матрица (K, D) с нормированными строками вместо списка словарей
+    M = np.asarray([c["vector"] for c in chunks], dtype=np.float32)
+    M /= np.linalg.norm(M, axis=1, keepdims=True)
+    return {
+        "M": M,
+        "texts": [c["text"] for c in chunks],
+        # У каждого фрагмента список источников (после дедупликации их может быть несколько)
+        "sources": [c["source"] if isinstance(c["source"], list) else [c["source"]] for c in chunks],
+    }
 
-import streamlit as st
-import os
-import numpy as np
-import pickle  # Библиотека для сохранения объектов на диск
-from pypdf import PdfReader
-from openai import OpenAI
-
-# Инициализация клиента OpenAI
-client = OpenAI()
-
-# Путь к файлу сохранения базы
-DB_FILE = "vector_db.pkl"
-
-with tab5:
+def save_db(db):
+    np.save(DB_VECTORS_FILE, db["M"])
+    with open(DB_META_FILE, "w", encoding="utf-8") as f:
+        json.dump({"texts": db["texts"], "sources": db["sources"]}, f, ensure_ascii=False)
+
+def db_exists():
+    return (os.path.exists(DB_VECTORS_FILE) and os.path.exists(DB_META_FILE)) or os.path.exists(LEGACY_DB_FILE)
+
+def add_search_index(db):
+    if faiss is not None:
+        # Строки нормированы, поэтому скалярное произведение == косинус.
+        # FAISS копирует векторы в свою память, так что отображенная матрица больше не нужна —
+        # выигрыш mmap по памяти остается только у запасного пути через numpy
+        index = faiss.IndexFlatIP(db["M"].shape[1])
+        index.add(np.ascontiguousarray(db.pop("M"), dtype=np.float32))
+        db["index"] = index
+    return db
+
+@st.cache_resource(show_spinner="Загрузка базы знаний с диска...")
+def load_vector_db():
+    # cache_resource отдает один и тот же объект всем сессиям без хеширования результата
+    if not (os.path.exists(DB_VECTORS_FILE) and os.path.exists(DB_META_FILE)):
+        with open(LEGACY_DB_FILE, "rb") as f:
+            db = pickle.load(f)
+        # Самый старый формат — список словарей с векторами
+        if isinstance(db, list):
+            db = build_db(db)
+        try:
+            save_db(db)
+        except OSError:
+            # Папка только для чтения — работаем с базой в памяти, как раньше с pickle
+            db["sources"] = [src if isinstance(src, list) else [src] for src in db["sources"]]
+            return add_search_index(db)
+
+    with open(DB_META_FILE, encoding="utf-8") as f:
+        meta = json.load(f)
+    # Матрица отображается в память: ОС подгружает только нужные страницы, без копии
+    db = {
+        "M": np.load(DB_VECTORS_FILE, mmap_mode="r"),
+        "texts": meta["texts"],
+        # Базы до дедупликации хранили один источник строкой — приводим к списку
+        "sources": [src if isinstance(src, list) else [src] for src in meta["sources"]],
+    }
+    return add_search_index(db)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def embed_query(text):
+    # Повторный вопрос не ходит в OpenAI; ndarray хешируется быстрее списка
+    response = client.embeddings.create(input=[text], model="text-embedding-3-small")
+    return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+def search_db(db, q, k):
+    # Индексы k самых похожих фрагментов для нормированного вектора запроса
+    if "index" in db:
+        _, I = db["index"].search(q.reshape(1, -1), min(k, db["index"].ntotal))
+        return I[0]
+    return top_k_indices(db["M"] @ q, k)
+
+def render_tab5():
     st.header("🤖 ИИ-Аналитик (Постоянная база)")
     st.info("Документы индексируются один раз и сохраняются на диск для экономии времени и API-лимитов.")
 
@@ -521,55 +685,106 @@ with tab5:
         chunks = []
         for filename in filenames:
             if os.path.exists(filename):
-                reader = PdfReader(filename)
-                for i, page in enumerate(reader.pages):
-                    text = page.extract_text()
-                    if text:
-                        mid = len(text) // 2
-                        chunks.append({"text": text[:mid], "source": f"{filename}, стр. {i+1}"})
-                        chunks.append({"text": text[mid:], "source": f"{filename}, стр. {i+1}"})
+                # mtime в ключе кэша: PDF перечитывается только если файл изменился
+                chunks.extend(extract_chunks(filename, os.path.getmtime(filename)))
         return chunks
 
-    # 2. Функция для получения эмбеддингов
-    def get_embedding(text):
-        return client.embeddings.create(input=[text], model="text-embedding-3-small").data[0].embedding
+    # 2. Функции для получения эмбеддингов
+    # Лимиты text-embedding-3-small: 8191 токен на один текст и ~300k токенов на запрос.
+    # Русский текст в cl100k дает ~2 символа на токен; берем худший случай 1 символ = 1 токен
+    EMBED_BATCH_SIZE = 128       # Сколько чанков отправляем за один запрос
+    EMBED_BATCH_CHARS = 250_000  # Лимит суммарной длины текстов в запросе (< 300k токенов)
+    EMBED_CHUNK_CHARS = 8_000    # Лимит длины одного текста (< 8191 токена)
+    EMBED_MAX_CONCURRENCY = 8    # Параллельных запросов к OpenAI (держимся в рамках RPM/TPM)
+    EMBED_MAX_ATTEMPTS = 3       # Повторы при RateLimit, сбоях сети/таймаутах и 5xx
+
+    async def embed_all_batches(batches):
+        # Отправляем все пачки параллельно, ограничивая число одновременных запросов
+        # Встроенные повторы SDK отключены — повторами управляет цикл ниже
+        aclient = AsyncOpenAI(api_key=api_key, max_retries=0)
+        sem = asyncio.Semaphore(EMBED_MAX_CONCURRENCY)
+
+        async def embed_batch(texts):
+            async with sem:
+                for attempt in range(EMBED_MAX_ATTEMPTS):
+                    try:
+                        response = await aclient.embeddings.create(input=texts, model="text-embedding-3-small")
+                        return [d.embedding for d in response.data]
+                    # APIConnectionError покрывает и APITimeoutError
+                    except (RateLimitError, APIConnectionError, InternalServerError):
+                        if attempt == EMBED_MAX_ATTEMPTS - 1:
+                            raise
+                        # Экспоненциальная пауза: 1, 2, 4... секунды
+                        await asyncio.sleep(2 ** attempt)
+
+        try:
+            return await asyncio.gather(*[embed_batch([c["text"] for c in b]) for b in batches])
+        finally:
+            await aclient.close()
+
+    def split_long_chunks(chunks):
+        # Половина страницы обычно в разы короче лимита, но слишком длинные куски режем, а не теряем запрос
+        out = []
+        for c in chunks:
+            text = c["text"]
+            for start in range(0, len(text), EMBED_CHUNK_CHARS):
+                out.append({**c, "text": text[start:start + EMBED_CHUNK_CHARS]})
+        return out
+
+    def make_batches(chunks):
+        # Режем список на пачки по количеству и по суммарной длине текста
+        batch, batch_chars = [], 0
+        for chunk in chunks:
+            n = len(chunk["text"])
+            if batch and (len(batch) >= EMBED_BATCH_SIZE or batch_chars + n > EMBED_BATCH_CHARS):
+                yield batch
+                batch, batch_chars = [], 0
+            batch.append(chunk)
+            batch_chars += n
+        if batch:
+            yield batch
 
     # 3. Основная логика загрузки/сохранения
-    if "db_chunks" not in st.session_state:
-        # Пытаемся загрузить с диска
-        if os.path.exists(DB_FILE):
-            with st.spinner("Загрузка базы знаний с диска..."):
-                with open(DB_FILE, "rb") as f:
-                    st.session_state.db_chunks = pickle.load(f)
-            st.success("База знаний успешно загружена из памяти!")
-        else:
-            # Если файла нет — индексируем
-            with st.spinner("Первичная индексация документов (создание файла базы)..."):
-                files = [
-                    "Strategiya-razvitiya-AO-Bank-Razvitiya-Kazakhstana-na-2024_2033-gody-2.pdf",
-                    "Kons-FO_2024.pdf"
-                ]
-                raw_chunks = get_pdf_chunks(files)
-                
-                if not raw_chunks:
-                    st.error("Файлы PDF не найдены! Проверьте наличие документов в папке проекта.")
-                    st.stop()
-
-                # Считаем векторы
-                for chunk in raw_chunks:
-                    chunk["vector"] = get_embedding(chunk["text"])
-                
-                # Сохраняем результат на диск
-                with open(DB_FILE, "wb") as f:
-                    pickle.dump(raw_chunks, f)
-                
-                st.session_state.db_chunks = raw_chunks
-                st.success(f"База знаний создана и сохранена в '{DB_FILE}'!")
+    # Пытаемся загрузить с диска
+    if db_exists():
+        db = load_vector_db()
+    else:
+        # Если файла нет — индексируем
+        with st.spinner("Первичная индексация документов (создание файла базы)..."):
+            files = [
+                "Strategiya-razvitiya-AO-Bank-Razvitiya-Kazakhstana-na-2024_2033-gody-2.pdf",
+                "Kons-FO_2024.pdf"
+            ]
+            raw_chunks = get_pdf_chunks(files)
+            
+            if not raw_chunks:
+                st.error("Файлы PDF не найдены! Проверьте наличие документов в папке проекта.")
+                st.stop()
+
+            raw_chunks = split_long_chunks(dedupe_chunks(raw_chunks))
+
+            # Считаем векторы пачками, пачки отправляем параллельно
+            batches = list(make_batches(raw_chunks))
+            results = asyncio.run(embed_all_batches(batches))
+            for batch, vectors in zip(batches, results):
+                for chunk, vec in zip(batch, vectors):
+                    chunk["vector"] = vec
+            
+            db = build_db(raw_chunks)
+
+            # Сохраняем результат на диск и берем базу через общий загрузчик (с индексом поиска)
+            save_db(db)
+            load_vector_db.clear()
+            db = load_vector_db()
+
+            st.success(f"База знаний создана и сохранена в '{DB_VECTORS_FILE}' и '{DB_META_FILE}'!")
 
     # Кнопка для переиндексации (если добавили новые файлы)
     if st.button("Обновить базу знаний (переиндексировать)"):
-        if os.path.exists(DB_FILE):
-            os.remove(DB_FILE)
+        for path in (DB_VECTORS_FILE, DB_META_FILE, LEGACY_DB_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+        load_vector_db.clear()
         st.rerun()
 
     # --- Дальше идет ваш стандартный интерфейс чата (без изменений) ---
@@ -587,36 +802,33 @@ with tab5:
 
         with st.chat_message("assistant"):
             with st.spinner("Ищу в тексте..."):
-                query_vec = get_embedding(prompt)
-                
-                similarities = []
-                # Важно: используем векторы из загруженной базы
-                for chunk in st.session_state.db_chunks:
-                    dot_product = np.dot(query_vec, chunk["vector"])
-                    norm_q = np.linalg.norm(query_vec)
-                    norm_c = np.linalg.norm(chunk["vector"])
-                    score = dot_product / (norm_q * norm_c)
-                    similarities.append(score)
-                
-                top_indices = np.argsort(similarities)[-4:][::-1]
-                context = "\n\n".join([st.session_state.db_chunks[i]["text"] for i in top_indices])
-                sources = [st.session_state.db_chunks[i]["source"] for i in top_indices]
-
-                response = client.chat.completions.create(
-                    model="gpt-4-turbo",
+                query_vec = embed_query(prompt)
+
+                # Строки матрицы уже нормированы — достаточно нормировать запрос
+                q = query_vec / np.linalg.norm(query_vec)
+
+                top_indices = search_db(db, q, TOP_K)
+                context = "\n\n".join([db["texts"][i] for i in top_indices])
+                sources = [src for i in top_indices for src in db["sources"][i]]
+
+                stream = client.chat.completions.create(
+                    model="gpt-4o-mini",
                     messages=[
                         {"role": "system", "content": "Ты аналитик БРК. Отвечай только по тексту. Если нет данных, скажи 'Не найдено'."},
                         {"role": "user", "content": f"Контекст:\n{context}\n\nВопрос: {prompt}"}
                     ],
-                    temperature=0
+                    temperature=0,
+                    stream=True
                 )
-                
-                answer = response.choices[0].message.content
-                st.markdown(answer)
-                
-                with st.expander("📚 Источники"):
-                    for s in set(sources):
-                        st.write(f"📍 {s}")
+
+            # Выводим ответ по мере генерации, не дожидаясь полного текста
+            answer = st.write_stream(
+                ev.choices[0].delta.content or "" for ev in stream if ev.choices
+            )
+
+            with st.expander("📚 Источники"):
+                for s in set(sources):
+                    st.write(f"📍 {s}")
             
             st.session_state.messages.append({"role": "assistant", "content": answer})
 
@@ -627,5 +839,16 @@ with tab5:
 
 
 
+# Streamlit выполняет тела всех st.tabs на каждом перезапуске, поэтому рисуем только выбранный раздел
+SECTIONS = {
+    "📈 Макро-эффект": lambda: render_tab1(df_annual, display_options),
+    "⚙️ Эффективность": lambda: render_tab2(df_prod, st.session_state.cum_slider_fixed),
+    "🗺️ Регионы": lambda: render_tab3(df_projects),
+    "📁 Портфель проектов": render_tab4,
+    "🤖 ИИ-Ассистент": render_tab5,
+}
+active = st.radio("Раздел", list(SECTIONS), horizontal=True, key="active_tab", label_visibility="collapsed")
+SECTIONS[active]()
+
 st.markdown("---")
 st.caption("Подготовлено для Департамента стратегии и анализа больших данных БРК. Данные: Бюро национальной статистики РК.")
\ No newline at end of file